@@ -1,11 +1,17 @@
 #!/usr/bin/env bash
 # spell — um gerenciador de programas simples para LFS/ports
 # Licença: MIT
-# Requisitos: bash 4+, coreutils, curl, git, tar, xz, unzip, gzip, bzip2, zstd, patch, sha256sum,
+# Requisitos: bash 4.4+, coreutils, curl, git, tar, xz, unzip, gzip, bzip2, zstd, patch, sha256sum,
 #             rsync, fakeroot (opcional mas recomendado), jq (opcional p/ saída)
 # Testado: Linux base, sem systemd dependente. Use por sua conta e risco.
 
+# 4.4: inherit_errexit e "${arr[@]}" vazio sob set -u; 4.3: wait -n
+if (( BASH_VERSINFO[0] < 4 || (BASH_VERSINFO[0] == 4 && BASH_VERSINFO[1] < 4) )); then
+  echo "spell requer bash >= 4.4 (encontrado: $BASH_VERSION)" >&2; exit 1
+fi
+
 set -euo pipefail
+shopt -s inherit_errexit   # falhas dentro de $(...) também abortam
 IFS=$'\n\t'
 
 VERSION="0.2.0"
@@ -23,6 +29,7 @@ VERSION="0.2.0"
 : "${SPELL_LOGS:=$SPELL_HOME/logs}"                               # logs de build/install
 : "${SPELL_DB:=$SPELL_HOME/db}"                                   # base instalada (metadados + files)
 : "${SPELL_HOOKS:=$SPELL_ETC/hooks}"                              # hooks (pre-install, post-remove, etc)
+: "${SPELL_CACHE:=$SPELL_HOME/formulae.cache}"                    # metadados das fórmulas (mtime/tamanho)
 : "${SPELL_COLOR:=1}"
 : "${SPELL_SPINNER:=1}"
 
@@ -44,43 +51,83 @@ else
   C_RESET=''; C_BOLD=''; C_DIM=''; C_RED=''; C_GREEN=''; C_YELLOW=''; C_BLUE=''
 fi
 
-msg() { printf "%b\n" "${C_BOLD}$*${C_RESET}"; }
-info() { printf "%b\n" "${C_BLUE}==>${C_RESET} $*"; }
-ok()   { printf "%b\n" "${C_GREEN}✔${C_RESET} $*"; }
-warn() { printf "%b\n" "${C_YELLOW}⚠${C_RESET} $*"; }
+# mensagens vão para stderr: o stdout das etapas é só o caminho que elas
+# devolvem via $(...)
+msg() { printf "%b\n" "${C_BOLD}$*${C_RESET}" 1>&2; }
+info() { printf "%b\n" "${C_BLUE}==>${C_RESET} $*" 1>&2; }
+ok()   { printf "%b\n" "${C_GREEN}✔${C_RESET} $*" 1>&2; }
+warn() { printf "%b\n" "${C_YELLOW}⚠${C_RESET} $*" 1>&2; }
 err()  { printf "%b\n" "${C_RED}✖${C_RESET} $*" 1>&2; }
 
 SP_PID=""
 start_spinner() {
-  [[ ${SPELL_SPINNER} -eq 1 && -t 1 ]] || return 0
-  local chars='⠋⠙⠚⠞⠖⠦⠴⠲⠳⠓'
-  ( while :; do for ((i=0;i<${#chars};i++)); do printf "\r%s" "${chars:i:1}"; sleep 0.08; done; done ) &
+  # vai para stderr: o stdout das etapas costuma estar em $(...)
+  [[ ${SPELL_SPINNER} -eq 1 && -t 2 ]] || return 0
+  local -a frames=(⠋ ⠙ ⠚ ⠞ ⠖ ⠦ ⠴ ⠲ ⠳ ⠓)
+  # espera com `read -t` num pipe que nunca recebe dados (builtin, sem
+  # fork de sleep a cada quadro); encerra sozinho se o spell morrer
+  ( exec 3<> <(:)
+    while kill -0 "$$" 2>/dev/null; do
+      for f in "${frames[@]}"; do printf "\r%s" "$f" >&2; read -r -t 0.08 -u 3 _ || :; done
+    done ) &
   SP_PID=$!
 }
-stop_spinner() { [[ -n ${SP_PID} ]] && { kill "$SP_PID" >/dev/null 2>&1 || true; printf "\r \r"; SP_PID=""; }; }
+stop_spinner() {
+  if [[ -n ${SP_PID} ]]; then
+    kill "$SP_PID" >/dev/null 2>&1 || true; wait "$SP_PID" 2>/dev/null || true
+    printf "\r \r" >&2; SP_PID=""
+  fi
+}
 
-logfile() { mkdir -p "$SPELL_LOGS/$1"; printf "%s/%s/%s.log" "$SPELL_LOGS" "$1" "$(date +%Y%m%d-%H%M%S)"; }
+logfile() { [[ -d "$SPELL_LOGS/$1" ]] || mkdir -p "$SPELL_LOGS/$1"; printf "%s/%s/%(%Y%m%d-%H%M%S)T.log" "$SPELL_LOGS" "$1" -1; }
 
 have() { command -v "$1" >/dev/null 2>&1; }
 
+# Padrões usados em laços (patches, nomes de pacote), definidos uma vez
+RE_HTTP='^https?://'
+RE_GITREPO='^git://|^https?://.*\.git$'
+RE_PKGFILE='^([^/]+)-([^-]+)-([0-9]+)\.tar\.(zst|xz|gz)$'
+
 ########################################
 # Formato de fórmula (*.spell)
 # Arquivo bash que define:
 #   NAME, VERSION, RELEASE (opcional), URL (tarball) OU GIT (url,branch,commit)
-#   SHA256 (tarball), DEPENDS=(...) opcional
+#   GIT_PATHS=(...) opcional: sparse-checkout só destes caminhos
+#   SHA256 e/ou SHA512 (tarball), DEPENDS=(...) opcional
 #   PATCHES=( local/dir/*.patch | http(s):// | git:// ) opcional
 #   BUILD() { ./configure --prefix=/usr; make; }  (obrigatório ou default)
 #   INSTALL() { make DESTDIR="$DESTDIR" install; } (opcional; default faz isso)
 #   STRIP_BINARIES=1 (padrão 1)
 ########################################
 
+# As etapas (fetch, unpack, patch, build, bin) chamam load_formula em
+# cadeia; a fórmula já carregada não é lida de novo
+LOADED_FORMULA=""
+
 load_formula() {
   local name="$1"; local path="$SPELL_FORMULAE/$name.spell"
   [[ -f "$path" ]] || { err "Fórmula não encontrada: $name ($path)"; exit 1; }
+  [[ $LOADED_FORMULA == "$name" ]] && return 0
+  unset -v NAME VERSION RELEASE URL SHA256 SHA512 GIT GIT_BRANCH GIT_COMMIT GIT_PATHS PATCHES \
+           STRIP_BINARIES
+  unset -f BUILD INSTALL
+  DEPENDS=(); LOADED_FORMULA=""
   # shellcheck disable=SC1090
   source "$path"
   : "${NAME:?defina NAME na fórmula}"; : "${VERSION:?defina VERSION}"; : "${RELEASE:=1}"
-  : "${DEPENDS:=()}"; : "${STRIP_BINARIES:=1}"
+  : "${STRIP_BINARIES:=1}"
+  LOADED_FORMULA="$name"
+}
+
+# Preenche FORMULAE com os nomes das fórmulas: um único glob, sem ocultos
+# e sem basename por arquivo
+list_formulae() {
+  FORMULAE=()
+  local f n
+  for f in "$SPELL_FORMULAE"/*.spell; do
+    [[ -f "$f" ]] || continue
+    n=${f##*/}; FORMULAE+=("${n%.spell}")
+  done
 }
 
 # Extrai um campo simples sem executar a fórmula (uso: formula_field pkg VERSION)
@@ -98,59 +145,240 @@ formula_field() {
   ' "$path"
 }
 
+########################################
+# Cache de metadados das fórmulas
+# Uma linha por fórmula, campos separados por \x1f:
+#   nome  mtime:ctime:inode:tamanho (ns)  NAME  VERSION  RELEASE  DEPENDS (separados por espaço)
+#   URL  GIT  GIT_BRANCH  GIT_COMMIT
+# Evita re-source de fórmulas inalteradas em topo_order/upgrade/info.
+########################################
+
+declare -A META_STAMP=() META_LINE=()
+META_LOADED=0; META_DIRTY=0
+MS=$'\x1f'
+META_FORMAT="#spell-cache 2"
+META_STAT_FMT='%.9Y:%.9Z:%i:%s'   # resolução de ns: edições no mesmo segundo invalidam
+
+meta_cache_load() {
+  (( META_LOADED )) && return 0
+  META_LOADED=1
+  local n st rest
+  if [[ -f "$SPELL_CACHE" ]]; then
+    { IFS= read -r n || true
+      if [[ $n == "$META_FORMAT" ]]; then
+        while IFS="$MS" read -r n st rest; do META_LINE[$n]="$st$MS$rest"; done
+      fi
+    } < "$SPELL_CACHE"
+  fi
+  # um único stat para todas as fórmulas
+  local -a all=("$SPELL_FORMULAE"/*.spell)
+  [[ -e ${all[0]} ]] || return 0
+  while IFS="$MS" read -r n st; do
+    n=${n##*/}; META_STAMP[${n%.spell}]=$st
+  done < <(stat -c "%n$MS$META_STAT_FMT" "${all[@]}")
+}
+
+# Preenche F_NAME, F_VERSION, F_RELEASE, F_DEPENDS (array), F_URL, F_GIT,
+# F_GIT_BRANCH e F_GIT_COMMIT de uma fórmula
+formula_meta() {
+  local name="$1"; local path="$SPELL_FORMULAE/$name.spell" st line
+  [[ -f "$path" ]] || { err "Fórmula não encontrada: $name ($path)"; exit 1; }
+  meta_cache_load
+  st=${META_STAMP[$name]:-}
+  [[ -n $st ]] || { st=$(stat -c "$META_STAT_FMT" "$path"); META_STAMP[$name]=$st; }
+  line=${META_LINE[$name]:-}
+  if [[ ${line%%"$MS"*} != "$st" ]]; then
+    load_formula "$name" >/dev/null
+    local IFS=' '
+    line="$st$MS$NAME$MS$VERSION$MS$RELEASE$MS${DEPENDS[*]}$MS${URL:-}$MS${GIT:-}"
+    line+="$MS${GIT_BRANCH:-}$MS${GIT_COMMIT:-}"
+    META_LINE[$name]=$line; META_DIRTY=1
+  fi
+  local deps
+  IFS="$MS" read -r _ F_NAME F_VERSION F_RELEASE deps F_URL F_GIT F_GIT_BRANCH F_GIT_COMMIT <<<"$line"
+  IFS=' ' read -r -a F_DEPENDS <<<"$deps"
+}
+
+meta_cache_save() {
+  (( META_DIRTY )) || return 0
+  local tmp="$SPELL_CACHE.$$" n
+  { printf "%s\n" "$META_FORMAT"
+    for n in "${!META_LINE[@]}"; do printf "%s%s%s\n" "$n" "$MS" "${META_LINE[$n]}"; done
+  } > "$tmp" && mv -f "$tmp" "$SPELL_CACHE"
+  META_DIRTY=0
+}
+trap 'meta_cache_save || true' EXIT
+
 ########################################
 # Resolução de dependências (topo + reverse)
 ########################################
 
+# Fecho de dependências de "$@": preenche deps/nodes, locais de quem chama.
+# Cada fórmula é consultada uma única vez (via cache de metadados).
+_topo_discover() {
+  local -a queue=("$@")
+  local head=0 pkg d
+  while (( head < ${#queue[@]} )); do
+    pkg=${queue[head++]}
+    [[ -n ${deps[$pkg]+x} ]] && continue
+    [[ -f "$SPELL_FORMULAE/$pkg.spell" ]] || { err "Fórmula ausente: $pkg"; exit 1; }
+    formula_meta "$pkg"
+    deps[$pkg]="${F_DEPENDS[*]}"; nodes+=("$pkg")
+    for d in "${F_DEPENDS[@]}"; do
+      # tsort aceitaria "p p" como mera declaração de nó; rejeita aqui para
+      # os dois caminhos (tsort e Kahn) concordarem
+      [[ $d == "$pkg" ]] && { err "Dependência cíclica: $pkg depende de si mesma"; exit 1; }
+      [[ -n $d ]] && queue+=("$d")
+    done
+  done
+  meta_cache_save
+}
+
+# Kahn por rodadas sobre deps/nodes: imprime uma camada por linha (pacotes
+# separados por espaço); cada camada só depende das anteriores -> O(N+E)
+_topo_kahn_layers() {
+  local -A indeg=() rev=()
+  local -a layer=() next=()
+  local pkg d line seen=0
+  for pkg in "${nodes[@]}"; do
+    indeg[$pkg]=0
+    for d in ${deps[$pkg]}; do rev[$d]+="$pkg"$'\n'; (( ++indeg[$pkg] )); done
+  done
+  for pkg in "${nodes[@]}"; do
+    if (( indeg[$pkg] == 0 )); then layer+=("$pkg"); fi
+  done
+  while (( ${#layer[@]} )); do
+    printf -v line "%s " "${layer[@]}"; printf "%s\n" "${line% }"
+    (( seen += ${#layer[@]} )); next=()
+    for pkg in "${layer[@]}"; do
+      for d in ${rev[$pkg]:-}; do
+        if (( --indeg[$d] == 0 )); then next+=("$d"); fi
+      done
+    done
+    layer=("${next[@]}")
+  done
+  if (( seen < ${#nodes[@]} )); then
+    local cyc=""
+    for pkg in "${nodes[@]}"; do if (( indeg[$pkg] > 0 )); then cyc+=" $pkg"; fi; done
+    err "Dependência cíclica entre:$cyc"; exit 1
+  fi
+}
+
+topo_layers() {
+  local -A deps=(); local -a nodes=()
+  _topo_discover "$@"
+  _topo_kahn_layers
+}
+
 topo_order() {
-  declare -A seen; declare -a order
-  local visit
-  visit() {
-    local pkg="$1"
-    [[ -n ${seen[$pkg]:-} ]] && { [[ ${seen[$pkg]} == done ]] || true; return 0; }
-    seen[$pkg]=visiting
-    load_formula "$pkg" >/dev/null 2>&1 || { err "Fórmula ausente: $pkg"; exit 1; }
-    local d
-    for d in "${DEPENDS[@]:-}"; do visit "$d"; done
-    seen[$pkg]=done; order+=("$pkg")
-  }
-  local t
-  for t in "$@"; do visit "$t"; done
-  printf "%s\n" "${order[@]}"
+  local -A deps=(); local -a nodes=()
+  local pkg d
+  _topo_discover "$@"
+  # tsort (coreutils) ordena em C; se faltar ou achar ciclo, o Kahn
+  # resolve/relata os membros do ciclo
+  if have tsort; then
+    local sorted
+    if sorted=$(for pkg in "${nodes[@]}"; do
+                  printf "%s %s\n" "$pkg" "$pkg"
+                  for d in ${deps[$pkg]}; do printf "%s %s\n" "$d" "$pkg"; done
+                done | tsort 2>/dev/null); then
+      printf "%s\n" "$sorted"; return 0
+    fi
+  fi
+  local layers
+  layers=$(_topo_kahn_layers)
+  printf "%s\n" "${layers// /$'\n'}"
+}
+
+# Grafo reverso dos instalados (db/*/depends), montado uma vez por execução.
+# Pacotes instalados antes do registro de depends ficam em RDEPS_UNKNOWN:
+# não há como saber do que dependem.
+declare -A RDEPS=()
+declare -a RDEPS_UNKNOWN=()
+RDEPS_LOADED=0
+
+reverse_graph_load() {
+  (( RDEPS_LOADED )) && return 0
+  RDEPS=(); RDEPS_UNKNOWN=(); RDEPS_LOADED=1
+  local rec pkg d
+  for rec in "$SPELL_DB"/*/; do
+    pkg=${rec%/}; pkg=${pkg##*/}
+    [[ -f "$rec/depends" ]] || { [[ -d $rec ]] && RDEPS_UNKNOWN+=("$pkg"); continue; }
+    while IFS= read -r d; do
+      if [[ -n $d ]]; then RDEPS[$d]+="$pkg"$'\n'; fi
+    done < "$rec/depends"
+  done
+}
+
+# Preenche REVDEPS com os pacotes ainda instalados que dependem de $1.
+# Não imprime: chamado no shell atual, o grafo carregado fica para as
+# próximas consultas.
+reverse_deps() {
+  reverse_graph_load
+  REVDEPS=()
+  local p
+  for p in ${RDEPS[$1]:-}; do
+    if [[ -d "$SPELL_DB/$p" ]]; then REVDEPS+=("$p"); fi
+  done
 }
 
-reverse_topo_order() { mapfile -t _o < <(topo_order "$@"); tac <<<"${_o[*]}" | tr ' ' '\n'; }
+# inverte em fluxo: sem array intermediário, here-string nem tr
+reverse_topo_order() { topo_order "$@" | tac; }
 
 ########################################
 # Download / verificação
 ########################################
 
+# Confere SHA256 e/ou SHA512 lendo o arquivo uma única vez
+verify_hashes() {
+  local file="$1" sums want
+  if [[ -n ${SHA256:-} && -n ${SHA512:-} ]]; then
+    # o $(...) só termina quando o sha512sum (fd 4) também fecha a saída
+    sums=$( { tee >(sha512sum >&4) < "$file" | sha256sum; } 4>&1 )
+  elif [[ -n ${SHA256:-} ]]; then
+    sums=$(sha256sum < "$file")
+  elif [[ -n ${SHA512:-} ]]; then
+    sums=$(sha512sum < "$file")
+  else
+    return 0
+  fi
+  for want in ${SHA256:-} ${SHA512:-}; do
+    [[ $'\n'$sums$'\n' == *$'\n'"${want,,}  -"$'\n'* ]] || { err "hash inválido para $file"; exit 1; }
+  done
+}
+
 fetch_source() {
   local name="$1"; load_formula "$name"
   mkdir -p "$SPELL_SRC/$NAME-$VERSION"
   if [[ -n ${URL:-} ]]; then
-    local fname="$SPELL_SRC/$NAME-$VERSION/$(basename "$URL")"
+    local fname="$SPELL_SRC/$NAME-$VERSION/${URL##*/}"
     if [[ ! -f "$fname" ]]; then
       info "Baixando $URL"
       curl -L --fail -o "$fname" "$URL"
     else
       info "Usando cache: $fname"
     fi
-    if [[ -n ${SHA256:-} ]]; then
-      (cd "$(dirname "$fname")" && echo "$SHA256  $(basename "$fname")" | sha256sum -c -) \
-        || { err "sha256 inválido para $fname"; exit 1; }
-    fi
+    verify_hashes "$fname"
     echo "$fname"
   elif [[ -n ${GIT:-} ]]; then
     local dest="$SPELL_SRC/$NAME-$VERSION/git"
+    # busca só o ref pedido, raso e sem blobs; o checkout baixa apenas os
+    # blobs necessários (restritos a GIT_PATHS com sparse-checkout)
     if [[ ! -d "$dest/.git" ]]; then
       info "Clonando $GIT"
-      git clone --depth=1 ${GIT_BRANCH:+-b "$GIT_BRANCH"} "$GIT" "$dest"
-      [[ -n ${GIT_COMMIT:-} ]] && (cd "$dest" && git reset --hard "$GIT_COMMIT")
+      git init -q "$dest"
+      git -C "$dest" remote add origin "$GIT"
     else
       info "Atualizando git: $dest"
-      (cd "$dest" && git fetch --all --tags && git reset --hard ${GIT_COMMIT:-origin/${GIT_BRANCH:-HEAD}})
     fi
+    if [[ -n ${GIT_PATHS:+x} ]]; then
+      git -C "$dest" sparse-checkout set "${GIT_PATHS[@]}"
+    elif [[ $(git -C "$dest" config --bool core.sparseCheckout || true) == true ]]; then
+      # GIT_PATHS saiu da fórmula: volta à árvore completa
+      git -C "$dest" sparse-checkout disable
+    fi
+    git -C "$dest" fetch -q --depth=1 --filter=blob:none origin "${GIT_COMMIT:-${GIT_BRANCH:-HEAD}}"
+    git -C "$dest" reset -q --hard FETCH_HEAD
     echo "$dest"
   else
     err "Defina URL ou GIT na fórmula $name"; exit 1
@@ -161,7 +389,19 @@ fetch_source() {
 # Descompactação para diretório de trabalho
 ########################################
 
-tar_supports_zstd() { tar --help 2>&1 | grep -q -- '--zstd'; }
+# Sonda uma única vez por execução se o tar tem --zstd nativo (main chama
+# antes de qualquer etapa em subshell, que herda TAR_ZSTD)
+TAR_ZSTD=""
+tar_supports_zstd() {
+  if [[ -z $TAR_ZSTD ]]; then
+    if tar --help 2>&1 | grep -- '--zstd' >/dev/null; then
+      TAR_ZSTD=1
+    else
+      TAR_ZSTD=0; warn "tar sem --zstd; usando zstd externo (GNU tar >= 1.31 recomendado)"
+    fi
+  fi
+  (( TAR_ZSTD ))
+}
 
 unpack_to_workdir() {
   local name="$1"; load_formula "$name"
@@ -173,18 +413,26 @@ unpack_to_workdir() {
     rsync -a --delete "$src/" "$wdir/"
   else
     case "$src" in
-      *.tar.gz|*.tgz)   tar -C "$wdir" --strip-components=1 -xzf "$src";;
-      *.tar.bz2|*.tbz2) tar -C "$wdir" --strip-components=1 -xjf "$src";;
-      *.tar.xz)         tar -C "$wdir" --strip-components=1 -xJf "$src";;
+      # GNU tar detecta gz/bz2/xz sozinho: uma chamada, sem flag por formato
+      *.tar.gz|*.tgz|*.tar.bz2|*.tbz2|*.tar.xz|*.tar)
+        tar -C "$wdir" --strip-components=1 -xf "$src";;
       *.tar.zst|*.tar.zstd)
         if tar_supports_zstd; then tar -C "$wdir" --strip-components=1 --zstd -xf "$src"
         else unzstd -c "$src" | tar -C "$wdir" --strip-components=1 -xf -; fi ;;
       *.zip)
-        unzip -q "$src" -d "$wdir"
-        local first; first=$(find "$wdir" -mindepth 1 -maxdepth 1 -type d | head -n1 || true)
-        [[ -n ${first:-} ]] && rsync -a "$first"/ "$wdir"/ && rm -rf "$first"
-        ;;
-      *.tar)            tar -C "$wdir" --strip-components=1 -xf "$src";;
+        # extrai ao lado e promove o diretório raiz único com um rename,
+        # em vez de copiá-lo (rsync) e apagar
+        local zdir="$wdir.zip" globs; local -a top
+        rm -rf "$zdir"; unzip -q "$src" -d "$zdir"
+        # shopt -p sai com 1 se alguma opção estiver desligada (o padrão)
+        globs=$(shopt -p dotglob nullglob || true); shopt -s dotglob nullglob
+        top=("$zdir"/*); eval "$globs"
+        rmdir "$wdir"
+        if (( ${#top[@]} == 1 )) && [[ -d ${top[0]} ]]; then
+          mv "${top[0]}" "$wdir"; rmdir "$zdir"
+        else
+          mv "$zdir" "$wdir"
+        fi ;;
       *) err "Formato não suportado: $src"; exit 1;;
     esac
   fi
@@ -194,29 +442,52 @@ unpack_to_workdir() {
 ########################################
 # Patches (dir, http(s), git)
 ########################################
+# curl >= 7.66 baixa várias URLs em paralelo numa única chamada (-Z)
+curl_parallel() {
+  [[ $(curl --version 2>/dev/null) =~ ^curl\ ([0-9]+)\.([0-9]+) ]] || return 1
+  (( BASH_REMATCH[1] > 7 || (BASH_REMATCH[1] == 7 && BASH_REMATCH[2] >= 66) ))
+}
+
 apply_patches() {
   local name="$1"; load_formula "$name"
   [[ -z ${PATCHES:+x} ]] && return 0
   local wdir="$SPELL_WORK/$NAME-$VERSION"; [[ -d "$wdir" ]] || wdir=$(unpack_to_workdir "$name")
   info "Aplicando patches"
+  # baixa tudo antes, em paralelo: URLs num único curl, repositórios git
+  # em clones simultâneos; a aplicação abaixo segue a ordem de PATCHES
+  local pdir; pdir=$(mktemp -d)
+  local -A got=(); local -a curlargs=() pids=(); local p i=0
+  for p in "${PATCHES[@]}"; do
+    [[ -n ${got[$p]:-} ]] && continue
+    if [[ "$p" =~ $RE_GITREPO ]]; then
+      got[$p]="$pdir/$((i++))"; git clone -q --depth=1 "$p" "${got[$p]}" & pids+=($!)
+    elif [[ "$p" =~ $RE_HTTP ]]; then
+      got[$p]="$pdir/$((i++)).patch"; curlargs+=(-o "${got[$p]}" "$p")
+    fi
+  done
+  if (( ${#curlargs[@]} )); then
+    local -a par=(); curl_parallel && par=(-Z)
+    curl -L --fail "${par[@]}" "${curlargs[@]}" || { wait; rm -rf "$pdir"; err "Falha ao baixar patches"; exit 1; }
+  fi
+  for i in "${pids[@]}"; do
+    wait "$i" || { wait; rm -rf "$pdir"; err "Falha ao clonar repositório de patches"; exit 1; }
+  done
   pushd "$wdir" >/dev/null
-  local p
   for p in "${PATCHES[@]}"; do
     if [[ -d "$p" ]]; then
-      for f in "$p"/*.patch; do [[ -e "$f" ]] || continue; info "patch < $(basename "$f")"; patch -p1 < "$f"; done
-    elif [[ "$p" =~ ^https?:// ]]; then
-      local tmp; tmp=$(mktemp); curl -L --fail -o "$tmp" "$p"; info "patch < $(basename "$p")"; patch -p1 < "$tmp"; rm -f "$tmp"
-    elif [[ "$p" =~ ^git://|^https?://.*\.git$ ]]; then
-      local tmpdir; tmpdir=$(mktemp -d); git clone --depth=1 "$p" "$tmpdir"
-      for f in "$tmpdir"/*.patch; do [[ -e "$f" ]] || continue; info "patch < $(basename "$f")"; patch -p1 < "$f"; done
-      rm -rf "$tmpdir"
+      for f in "$p"/*.patch; do [[ -e "$f" ]] || continue; info "patch < ${f##*/}"; patch -p1 < "$f"; done
+    elif [[ "$p" =~ $RE_GITREPO ]]; then
+      for f in "${got[$p]}"/*.patch; do [[ -e "$f" ]] || continue; info "patch < ${f##*/}"; patch -p1 < "$f"; done
+    elif [[ "$p" =~ $RE_HTTP ]]; then
+      info "patch < ${p##*/}"; patch -p1 < "${got[$p]}"
     elif [[ -f "$p" ]]; then
-      info "patch < $(basename "$p")"; patch -p1 < "$p"
+      info "patch < ${p##*/}"; patch -p1 < "$p"
     else
       warn "Ignorando origem de patch desconhecida: $p"
     fi
   done
   popd >/dev/null
+  rm -rf "$pdir"
 }
 
 ########################################
@@ -226,8 +497,9 @@ apply_patches() {
 build_package() {
   local name="$1"; load_formula "$name"
   local wdir; wdir=$(unpack_to_workdir "$name")
-  apply_patches "$name"
   local log; log=$(logfile "$NAME")
+  # saída do patch vai direto para o log, sem passar pelo $(build_package)
+  apply_patches "$name" >"$log"
   local DESTDIR="$wdir/_destdir"; export DESTDIR
   rm -rf "$DESTDIR"; mkdir -p "$DESTDIR"
   pushd "$wdir" >/dev/null
@@ -248,7 +520,7 @@ build_package() {
     if [[ ${STRIP_BINARIES} -eq 1 ]] && have strip; then
       find "$DESTDIR" -type f -perm -111 -exec strip --strip-unneeded {} + 2>/dev/null || true
     fi
-  } &>"$log"
+  } &>>"$log"
   stop_spinner
   ok "Build concluído: $NAME-$VERSION"
   popd >/dev/null
@@ -259,18 +531,12 @@ make_binary() {
   local name="$1"; load_formula "$name"
   local DESTDIR; DESTDIR=$(build_package "$name")
   local out="$SPELL_BINREPO/${NAME}-${VERSION}-${RELEASE}.tar.zst"
-  info "Gerando binário: $(basename "$out")"
-  if tar_supports_zstd; then
-    (cd "$DESTDIR" && tar --zstd -cf "$out" .)
-  else
-    (cd "$DESTDIR" && tar -cf - . | zstd -T0 -q -o "$out")
-  fi
-  # manifest
-  if tar_supports_zstd; then
-    tar -tf "$out" | sort > "$SPELL_BINREPO/${NAME}-${VERSION}-${RELEASE}.manifest"
-  else
-    zstd -d -c "$out" | tar -tf - | sort > "$SPELL_BINREPO/${NAME}-${VERSION}-${RELEASE}.manifest"
-  fi
+  local manifest="$SPELL_BINREPO/${NAME}-${VERSION}-${RELEASE}.manifest"
+  info "Gerando binário: ${out##*/}"
+  # tar | zstd -T0 (todos os núcleos); a listagem -v vai direto para o
+  # manifest, sem descompactar o pacote de novo
+  tar -C "$DESTDIR" --index-file="$manifest.tmp" -cvf - . | zstd -T0 -q -f -o "$out"
+  sort -o "$manifest" "$manifest.tmp"; rm -f "$manifest.tmp"
   ok "Binário criado em $out"
   echo "$out"
 }
@@ -285,59 +551,58 @@ run_hook() {
 }
 
 _install_tree_into_root() {
-  # copia de tmpdir para /
-  local from="$1"
-  if have fakeroot; then
-    fakeroot rsync -aH --delete-after "$from"/ /
-  else
-    rsync -aH --delete-after "$from"/ /
-  fi
+  # extrai o pacote direto em / (sem cópia intermediária); a listagem -v
+  # vai para $2 e vira a lista de arquivos do db
+  local tarball="$1" index="$2"
+  local -a fr=(); have fakeroot && fr=(fakeroot)
+  local -a opts=(-C / --keep-directory-symlink --no-overwrite-dir --index-file="$index" -xpv)
+  case "$tarball" in
+    *.tar.zst|*.tar.zstd)
+      if tar_supports_zstd; then "${fr[@]}" tar "${opts[@]}" --zstd -f "$tarball"
+      else zstd -d -c "$tarball" | "${fr[@]}" tar "${opts[@]}" -f -; fi ;;
+    *.tar.xz|*.tar.gz|*.tgz|*.tar) "${fr[@]}" tar "${opts[@]}" -f "$tarball";;
+    *) err "Formato binário não suportado: $tarball"; exit 1;;
+  esac
 }
 
 install_binary() {
   local tarball="$1"; local name ver rel
-  name=$(basename "$tarball" | sed -E 's/^([^/]+)-([^-]+)-([0-9]+)\.tar\.(zst|xz|gz)$/\1/')
-  ver=$(basename "$tarball" | sed -E 's/^([^/]+)-([^-]+)-([0-9]+)\.tar\.(zst|xz|gz)$/\2/')
-  rel=$(basename "$tarball" | sed -E 's/^([^/]+)-([^-]+)-([0-9]+)\.tar\.(zst|xz|gz)$/\3/')
-  [[ -n "$name" && -n "$ver" && -n "$rel" ]] || { err "Nome de pacote inválido: $(basename "$tarball")"; exit 1; }
+  [[ ${tarball##*/} =~ $RE_PKGFILE ]] || { err "Nome de pacote inválido: ${tarball##*/}"; exit 1; }
+  name=${BASH_REMATCH[1]}; ver=${BASH_REMATCH[2]}; rel=${BASH_REMATCH[3]}
   local log; log=$(logfile "$name")
   info "Instalando $name-$ver-$rel (log: $log)"
   start_spinner
   {
     run_hook pre-install "$name" || true
 
-    local tmp; tmp=$(mktemp -d)
-    case "$tarball" in
-      *.tar.zst|*.tar.zstd)
-        if tar_supports_zstd; then tar -C "$tmp" --zstd -xf "$tarball"
-        else zstd -d -c "$tarball" | tar -C "$tmp" -xf -; fi ;;
-      *.tar.xz) tar -C "$tmp" -xJf "$tarball";;
-      *.tar.gz|*.tgz) tar -C "$tmp" -xzf "$tarball";;
-      *.tar) tar -C "$tmp" -xf "$tarball";;
-      *) err "Formato binário não suportado: $tarball"; exit 1;;
-    esac
+    # registro montado à parte em .<pkg>.new; na troca o antigo vai antes
+    # para .<pkg>.old, então a todo momento existe um registro completo
+    # (db/<pkg> ou .<pkg>.old, que uma execução interrompida recupera aqui)
+    local rec="$SPELL_DB/.$name.new" old="$SPELL_DB/.$name.old"
+    if [[ ! -d "$SPELL_DB/$name" && -d "$old" ]]; then mv "$old" "$SPELL_DB/$name"; fi
+    rm -rf "$rec" "$old"; mkdir -p "$rec"
 
-    _install_tree_into_root "$tmp"
-    rm -rf "$tmp"
+    _install_tree_into_root "$tarball" "$rec/index"
+    sed 's#^#/#' "$rec/index" > "$rec/files"; rm -f "$rec/index"
 
-    mkdir -p "$SPELL_DB/$name"
-    printf "%s\n" "$ver" > "$SPELL_DB/$name/version"
-    printf "%s\n" "$rel" > "$SPELL_DB/$name/release"
-
-    # gerar lista de arquivos instalados a partir do tar
-    case "$tarball" in
-      *.tar.zst|*.tar.zstd)
-        if tar_supports_zstd; then
-          tar -tf "$tarball" | sed 's#^#/#' > "$SPELL_DB/$name/files"
-        else
-          zstd -d -c "$tarball" | tar -tf - | sed 's#^#/#' > "$SPELL_DB/$name/files"
-        fi ;;
-      *) tar -tf "$tarball" | sed 's#^#/#' > "$SPELL_DB/$name/files" ;;
-    esac
+    printf "%s\n" "$ver" > "$rec/version"
+    printf "%s\n" "$rel" > "$rec/release"
+    if [[ -f "$SPELL_FORMULAE/$name.spell" ]]; then
+      formula_meta "$name"; printf "%s\n" "${F_DEPENDS[@]}" > "$rec/depends"
+    fi
 
-    date -u +%FT%TZ > "$SPELL_DB/$name/installed_at"
+    date -u +%FT%TZ > "$rec/installed_at"
+    if [[ -d "$SPELL_DB/$name" ]]; then mv "$SPELL_DB/$name" "$old"; fi
+    mv "$rec" "$SPELL_DB/$name"
+    # reinstalação/upgrade: o que só a versão anterior trazia sai do sistema
+    if [[ -f "$old/files" ]]; then
+      _unlink_listed <(comm -23 <(LC_ALL=C sort "$old/files") <(LC_ALL=C sort "$SPELL_DB/$name/files")) \
+        "$SPELL_DB/$name/files"
+    fi
+    rm -rf "$old"
+    RDEPS_LOADED=0
     run_hook post-install "$name" || true
-  } &>"$log"
+  } &>>"$log"
   stop_spinner
   ok "Instalado: $name-$ver (release $rel)"
 }
@@ -350,21 +615,53 @@ install_from_source() {
 # Remoção (desfazendo instalação)
 ########################################
 
+# Apaga os caminhos da lista $1 (formato de db/<pkg>/files) e os diretórios
+# que ficarem vazios, exceto os diretórios listados em $2 (opcional)
+_unlink_listed() {
+  # um unlink por arquivo (sem stat antes) e uma única tentativa de rmdir
+  # por diretório; entradas de diretório do tar terminam em "/"
+  local -a files=(); local -A dirs=() keep=(); local f d
+  if [[ -n ${2:-} ]]; then
+    while IFS= read -r f; do
+      f=${f/#\/.\//\/}
+      if [[ $f == */ && $f != / ]]; then keep[${f%/}]=1; fi
+    done < "$2"
+  fi
+  while IFS= read -r f; do
+    [[ -n $f ]] || continue
+    f=${f/#\/.\//\/}
+    if [[ $f == */ ]]; then d=${f%/}; else files+=("$f"); d=${f%/*}; fi
+    while [[ -n $d && -z ${dirs[$d]:-} ]]; do dirs[$d]=1; d=${d%/*}; done
+  done < "$1"
+  for d in "${!keep[@]}"; do unset "dirs[$d]"; done
+  # como antes, um caminho que não sai (ex.: virou diretório) não interrompe
+  # a remoção: o rmdir, o db e o hook post-remove ainda precisam rodar
+  if (( ${#files[@]} )); then printf "%s\0" "${files[@]}" | xargs -0r rm -f -- 2>/dev/null || true; fi
+  # ordem lexicográfica reversa: filhos antes dos pais
+  if (( ${#dirs[@]} )); then
+    printf "%s\n" "${!dirs[@]}" | sort -r \
+      | xargs -r -d '\n' rmdir --ignore-fail-on-non-empty -- 2>/dev/null || true
+  fi
+}
+
 remove_package() {
   local name="$1"
   [[ -d "$SPELL_DB/$name" ]] || { warn "$name não está instalado"; return 0; }
+  if [[ ${SPELL_FORCE:-0} -ne 1 ]]; then
+    reverse_deps "$name"
+    if (( ${#REVDEPS[@]} )); then
+      local users; printf -v users "%s " "${REVDEPS[@]}"
+      err "$name é requerido por: ${users% } (use SPELL_FORCE=1 para remover mesmo assim)"
+      exit 1
+    fi
+    if (( ${#RDEPS_UNKNOWN[@]} )); then
+      local legacy; printf -v legacy "%s " "${RDEPS_UNKNOWN[@]}"
+      warn "sem registro de dependências (instalados por versão antiga): ${legacy% }; não verificados"
+    fi
+  fi
   run_hook pre-remove "$name" || true
   info "Removendo $name"
-  # remover em ordem reversa; tentar limpar diretórios ascendentes
-  tac "$SPELL_DB/$name/files" | while read -r f; do
-    [[ -z "$f" ]] && continue
-    if [[ -e "$f" || -L "$f" ]]; then
-      rm -f "$f" 2>/dev/null || true
-    fi
-    # tentar remover diretórios vazios ascendentes
-    local d; d=$(dirname "$f")
-    for _ in {1..6}; do rmdir "$d" 2>/dev/null || true; d=$(dirname "$d"); done
-  done
+  _unlink_listed "$SPELL_DB/$name/files"
   rm -rf "$SPELL_DB/$name"
   run_hook post-remove "$name" || true
   ok "Removido $name"
@@ -396,12 +693,12 @@ git_sync() {
 ########################################
 
 upgrade_one() {
-  local name="$1"; load_formula "$name"
-  local current=""; [[ -f "$SPELL_DB/$name/version" ]] && current=$(<"$SPELL_DB/$name/version") || true
-  if [[ "$current" == "$VERSION" ]]; then
-    info "$name já está na versão $VERSION"; return 0
+  local name="$1"; formula_meta "$name"
+  local current=""; [[ -f "$SPELL_DB/$name/version" ]] && read -r current < "$SPELL_DB/$name/version" || true
+  if [[ "$current" == "$F_VERSION" ]]; then
+    info "$name já está na versão $F_VERSION"; return 0
   fi
-  info "Atualizando $name: $current -> $VERSION"
+  info "Atualizando $name: $current -> $F_VERSION"
   install_from_source "$name"
 }
 
@@ -409,18 +706,28 @@ upgrade_one() {
 # Busca / info / list
 ########################################
 
-cmd_search() { local q="${1:-}"; ls -1 "$SPELL_FORMULAE"/*.spell 2>/dev/null | sed 's#.*/##;s/\.spell$//' | grep -i -- "$q" || true; }
+# Casa só pelo nome do arquivo (substring, sem diferenciar maiúsculas):
+# nenhuma fórmula é lida
+cmd_search() {
+  local q="${1:-}" n
+  list_formulae
+  for n in "${FORMULAE[@]}"; do
+    if [[ ${n,,} == *"${q,,}"* ]]; then printf "%s\n" "$n"; fi
+  done
+}
 
 cmd_info() {
-  local name="$1"; load_formula "$name"
-  echo "NAME: $NAME"
-  echo "VERSION: $VERSION"
-  echo "RELEASE: ${RELEASE:-1}"
-  echo "DEPENDS: ${DEPENDS[*]:-}"
-  [[ -n ${URL:-} ]] && echo "URL: $URL"
-  [[ -n ${GIT:-} ]] && echo "GIT: $GIT ${GIT_BRANCH:+(branch $GIT_BRANCH)} ${GIT_COMMIT:+@ $GIT_COMMIT}"
-  if [[ -d "$SPELL_DB/$NAME" ]]; then
-    echo "INSTALLED: yes ($(<"$SPELL_DB/$NAME/version"))"
+  local name="$1"; formula_meta "$name"
+  local IFS=' '
+  echo "NAME: $F_NAME"
+  echo "VERSION: $F_VERSION"
+  echo "RELEASE: $F_RELEASE"
+  echo "DEPENDS: ${F_DEPENDS[*]}"
+  [[ -n $F_URL ]] && echo "URL: $F_URL"
+  [[ -n $F_GIT ]] && echo "GIT: $F_GIT ${F_GIT_BRANCH:+(branch $F_GIT_BRANCH)} ${F_GIT_COMMIT:+@ $F_GIT_COMMIT}"
+  if [[ -d "$SPELL_DB/$F_NAME" ]]; then
+    local v=""; read -r v < "$SPELL_DB/$F_NAME/version" || true
+    echo "INSTALLED: yes ($v)"
   else
     echo "INSTALLED: no"
   fi
@@ -431,9 +738,9 @@ cmd_list() {
   for d in "$SPELL_DB"/*; do
     [[ -d "$d" ]] || continue
     local n v r
-    n=$(basename "$d")
-    v=$(<"$d/version")
-    r=$(<"$d/release" 2>/dev/null || echo 1)
+    n=${d##*/}; v=""; r=1
+    read -r v < "$d/version" || true
+    [[ -f "$d/release" ]] && { read -r r < "$d/release" || true; }
     echo "$n $v-$r"
   done
 }
@@ -458,18 +765,81 @@ clean() {
 ########################################
 
 install_with_deps() {
+  local jobs=""
+  case "${1:-}" in
+    -j|--jobs) jobs="${2:?informe N}"; shift 2;;
+    --jobs=*)  jobs="${1#--jobs=}"; shift;;
+    -j*)       jobs="${1#-j}"; shift;;
+  esac
+  [[ -n $jobs ]] || jobs=$(( $(nproc 2>/dev/null || echo 2) / 2 ))
+  (( jobs >= 1 )) || jobs=1
   local targets=("$@")
-  mapfile -t order < <(topo_order "${targets[@]}")
-  info "Ordem de build: ${order[*]}"
-  local p
-  for p in "${order[@]}"; do install_from_source "$p"; done
+  # $(...) e não < <(...): ciclo ou fórmula ausente precisam abortar aqui
+  local out; out=$(topo_layers "${targets[@]}")
+  local -a layers; mapfile -t layers <<<"$out"
+  local line p tmp running
+  printf -v line "[%s] " "${layers[@]}"
+  info "Ordem de build (camadas): ${line% }"
+  local -a layer
+  for line in "${layers[@]}"; do
+    IFS=' ' read -r -a layer <<<"$line"
+    if (( jobs == 1 || ${#layer[@]} == 1 )); then
+      for p in "${layer[@]}"; do install_from_source "$p"; done
+      continue
+    fi
+    # pacotes de uma camada não dependem entre si: compila em paralelo e
+    # instala em série (a instalação escreve em / e no db)
+    tmp=$(mktemp -d); running=0
+    for p in "${layer[@]}"; do
+      if (( running >= jobs )); then wait -n || true; else (( ++running )); fi
+      ( SPELL_SPINNER=0; make_binary "$p" > "$tmp/$p" ) &
+    done
+    wait || true
+    for p in "${layer[@]}"; do
+      [[ -s "$tmp/$p" ]] || { rm -rf "$tmp"; err "Falha ao compilar $p (veja $SPELL_LOGS/$p)"; exit 1; }
+    done
+    for p in "${layer[@]}"; do install_binary "$(<"$tmp/$p")"; done
+    rm -rf "$tmp"
+  done
 }
 
 remove_with_reverse_deps() {
   local targets=("$@")
-  mapfile -t order < <(reverse_topo_order "${targets[@]}")
-  info "Ordem de remoção: ${order[*]}"
+  local out; out=$(reverse_topo_order "${targets[@]}")
+  local -a order; mapfile -t order <<<"$out"
   local p
+  # valida o plano inteiro antes de remover qualquer coisa: um alvo que
+  # outro instalado (fora do plano) ainda usa aborta; uma dependência
+  # compartilhada só sai do plano. A ordem já vem com os dependentes
+  # primeiro, então quem fica retém também as dependências dele.
+  if [[ ${SPELL_FORCE:-0} -ne 1 ]]; then
+    local -A removing=() target=(); local -a plan=()
+    local u outside
+    for p in "${targets[@]}"; do target[$p]=1; done
+    for p in "${order[@]}"; do
+      if [[ -d "$SPELL_DB/$p" ]]; then removing[$p]=1; fi
+    done
+    for p in "${order[@]}"; do
+      if [[ -z ${removing[$p]:-} ]]; then
+        # não instalado: remove_package só avisa
+        if [[ ! -d "$SPELL_DB/$p" ]]; then plan+=("$p"); fi
+        continue
+      fi
+      reverse_deps "$p"; outside=""
+      for u in "${REVDEPS[@]}"; do
+        if [[ -z ${removing[$u]:-} ]]; then outside+="$u "; fi
+      done
+      if [[ -z $outside ]]; then plan+=("$p"); continue; fi
+      if [[ -n ${target[$p]:-} ]]; then
+        err "$p é requerido por: ${outside% } (use SPELL_FORCE=1 para remover mesmo assim)"
+        exit 1
+      fi
+      warn "Mantendo $p: ainda requerido por ${outside% }"
+      unset "removing[$p]"
+    done
+    order=("${plan[@]}")
+  fi
+  info "Ordem de remoção: ${order[*]}"
   for p in "${order[@]}"; do remove_package "$p"; done
 }
 
@@ -480,7 +850,7 @@ remove_with_reverse_deps() {
 scaffold() {
   local name="$1"; local path="$SPELL_FORMULAE/$name.spell"
   [[ -e "$path" ]] && { err "Já existe: $path"; exit 1; }
-  mkdir -p "$(dirname "$path")"
+  mkdir -p "${path%/*}"
   cat > "$path" <<'EOF'
 # Exemplo de fórmula spell (edite os campos)
 NAME="hello"
@@ -521,8 +891,10 @@ Comandos principais:
   build <pkg>                   Compila e prepara DESTDIR
   bin   <pkg>                   Gera pacote binário (.tar.zst)
   install <pkg>                 Compila e instala (com DESTDIR/fakeroot)
-  install-order <pkgs...>       Instala com resolução topológica (deps primeiro)
-  remove <pkg>                  Remove pacote instalado
+  install-order [-j N] <pkgs...> Instala com resolução topológica (deps primeiro);
+                                -j compila N pacotes independentes em paralelo
+  remove <pkg>                  Remove pacote instalado (recusa se outro depender dele;
+                                instalados sem db/<pkg>/depends não entram na checagem)
   remove-order <pkgs...>        Remove em ordem reversa de dependências
   search <texto>                Procura por fórmulas
   info <pkg>                    Informações da fórmula + status
@@ -533,6 +905,8 @@ Comandos principais:
 
 Opções de ambiente:
   SPELL_COLOR=0 desativa cores; SPELL_SPINNER=0 desativa spinner
+  SPELL_FORCE=1 remove pacotes mesmo que outros instalados dependam deles
+  ZSTD_CLEVEL=N nível de compressão dos pacotes binários (zstd)
 Diretórios:
   Fórmulas: $SPELL_FORMULAE
   Estado:   $SPELL_HOME
@@ -541,6 +915,11 @@ EOF
 
 main() {
   local cmd="${1:-}"; shift || true
+  # as etapas de unpack/bin/install rodam dentro de $(...) e em jobs
+  # paralelos; sondar aqui, no processo pai, faz o resultado valer para todos
+  case "${cmd}" in
+    unpack|patch|build|bin|install|install-order|upgrade) tar_supports_zstd || true;;
+  esac
   case "${cmd}" in
     init) ok "Spell inicializado em $SPELL_HOME";;
     create) scaffold "${1:?informe o nome}";;
@@ -558,8 +937,8 @@ main() {
     list) cmd_list;;
     upgrade)
       if [[ "${1:-}" == "--all" ]]; then
-        shopt -s nullglob
-        for f in "$SPELL_FORMULAE"/*.spell; do n=$(basename "$f" .spell); upgrade_one "$n"; done
+        list_formulae
+        for n in "${FORMULAE[@]}"; do upgrade_one "$n"; done
       else
         upgrade_one "${1:?pkg}"
       fi